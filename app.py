@@ -3,12 +3,18 @@
 # Dieses Skript ruft stündliche Niederschlagsdaten für einen gewählten Tag ab
 # und vergleicht zwei Stationen in Hamburg: Neuwiedenthal und Fuhlsbüttel
 
+import numpy as np
 import pandas as pd
-import requests, zipfile, io, fnmatch
-from datetime import datetime, date
+import requests, zipfile, io, functools, shutil, json, os, itertools, contextlib
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta
+import matplotlib
+matplotlib.use("Agg")  # nur Rendern in Dateien/Puffer, kein interaktives Backend
 import matplotlib.pyplot as plt
 from fpdf import FPDF
 import tempfile
+from pathlib import Path
 
 # GUI-Kompatibilität
 try:
@@ -17,72 +23,201 @@ try:
 except ImportError:
     GUI = False
 
+# Caching: in der GUI über Streamlit (Ablauf nach einer Stunde), im Terminal prozesslokal.
+# Plot-PNGs werden nur in der GUI zwischengespeichert, wo Streamlit das Skript bei jeder Eingabe neu ausführt.
+if GUI:
+    cache_data = st.cache_data(ttl=3600, show_spinner=False)
+    cache_plot = st.cache_data(max_entries=32, show_spinner=False)
+else:
+    cache_data = functools.lru_cache(maxsize=32)
+    cache_plot = lambda func: func
+
+DWD_URL = "https://opendata.dwd.de/climate_environment/CDC/observations_germany/climate/hourly/precipitation/recent/stundenwerte_RR_{station_id}_akt.zip"
+
+# Lokaler Parquet-Cache der geparsten Archive, per bedingtem Abruf (ETag/Last-Modified) validiert
+# Liegt unter ~/.cache statt im Temp-Verzeichnis, damit er auch spätere Aufrufe im Terminal beschleunigt.
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "dwd_tool"
+CACHE_VERSION = 2  # bei Änderungen am Inhalt der Cache-Dateien erhöhen
+
+# Gemeinsame Session: eine TCP/TLS-Verbindung zu opendata.dwd.de für alle Stationen
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+SESSION.headers.update({"Accept-Encoding": "gzip"})
+
 stationen = {
     "Hamburg-Neuwiedenthal": {"id": "01981", "coords": "53.466, 9.933"},
     "Hamburg-Fuhlsbüttel (Flughafen)": {"id": "01975", "coords": "53.633, 10.000"}
 }
 
-def lade_daten(datum: date, station_id: str):
-    url = f"https://opendata.dwd.de/climate_environment/CDC/observations_germany/climate/hourly/precipitation/recent/stundenwerte_RR_{station_id}_akt.zip"
-    r = requests.get(url)
-    zf = zipfile.ZipFile(io.BytesIO(r.content))
-    data_file = [name for name in zf.namelist() if fnmatch.fnmatch(name, f"produkt_rr_stunde_*_{station_id}.txt")][0]
-    df = pd.read_csv(zf.open(data_file), sep=";", encoding="latin1")
-    df.columns = [c.strip() for c in df.columns]
+def _spool_response(r):
+    # Direkt aus der Antwort in eine Spool-Datei streamen (ab 8 MB auf Platte)
+    buf = tempfile.SpooledTemporaryFile(max_size=8 << 20)
+    r.raw.decode_content = True
+    shutil.copyfileobj(r.raw, buf)
+    buf.seek(0)
+    return buf
+
+def _mess_datum_to_datetime(mess_datum):
+    # MESS_DATUM ist eine ganze Zahl YYYYMMDDHH; Zerlegung ohne Umweg über Strings
+    v = mess_datum.to_numpy(np.int64)
+    parts = pd.DataFrame({"year": v // 1000000, "month": v // 10000 % 100,
+                          "day": v // 100 % 100, "hour": v % 100}, index=mess_datum.index)
+    return pd.to_datetime(parts)
+
+def _read_archive(zip_file, station_id: str) -> pd.DataFrame:
+    with zipfile.ZipFile(zip_file) as zf:
+        suffix = f"_{station_id}.txt"
+        data_file = next((n for n in zf.namelist() if n.startswith("produkt_rr_stunde_") and n.endswith(suffix)), None)
+        if data_file is None:
+            raise FileNotFoundError(f"produkt_rr_stunde_*_{station_id}.txt fehlt im Archiv")
+        with zf.open(data_file, "r") as f:
+            # Nur die beiden benötigten Spalten; skipinitialspace entfernt die DWD-Auffüllung im Kopf,
+            # der Fehlwert -999 wird schon beim Einlesen zu NaN
+            df = pd.read_csv(f, sep=";", encoding="latin1", skipinitialspace=True,
+                             usecols=["MESS_DATUM", "R1"], dtype={"MESS_DATUM": "int64", "R1": "float32"},
+                             na_values=["-999", "-999.0"])
     df.rename(columns={"R1": "precip_mm"}, inplace=True)
-    df["datetime"] = pd.to_datetime(df["MESS_DATUM"].astype(str), format="%Y%m%d%H")
-    df["precip_mm"] = pd.to_numeric(df["precip_mm"], errors="coerce").mask(lambda x: x < 0)
-    return df[df["datetime"].dt.date == datum][["datetime", "precip_mm"]]
+    return df[["MESS_DATUM", "precip_mm"]]
+
+@functools.lru_cache(maxsize=None)
+def _cache_dir() -> Path:
+    # Erst bei Bedarf anlegen; ist CACHE_DIR nicht beschreibbar (Container, Hosting), ins Temp-Verzeichnis ausweichen
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        if os.access(CACHE_DIR, os.W_OK):
+            return CACHE_DIR
+    except OSError:
+        pass
+    return Path(tempfile.gettempdir())
+
+def _write_atomic(path: Path, write):
+    # Erst in eine temporäre Datei schreiben, damit parallele Leser nie eine halbe Datei sehen
+    # Bei einem Fehler (volle Platte, Abbruch in to_parquet) die halbe temporäre Datei wieder entfernen
+    tmp = tempfile.NamedTemporaryFile(dir=path.parent, suffix=".tmp", delete=False)
+    try:
+        with tmp:
+            write(tmp)
+        os.replace(tmp.name, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp.name)
+        raise
+
+def _load_meta(meta_path: Path) -> dict:
+    # Sidecar {"version", "etag", "last_modified", "path"}; unbrauchbar → leeres Dict
+    try:
+        meta = json.loads(meta_path.read_text())
+    except (OSError, ValueError):
+        return {}
+    if meta.get("version") != CACHE_VERSION or not Path(meta.get("path", "")).is_file():
+        return {}
+    return meta
+
+@cache_data
+def _parse_station(station_id: str) -> pd.DataFrame:
+    meta_path = _cache_dir() / f"dwd_{station_id}.json"
+    meta = _load_meta(meta_path)
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+
+    # Bedingter Abruf: bei 304 ist das Archiv unverändert und der Parquet-Cache gültig
+    with SESSION.get(DWD_URL.format(station_id=station_id), headers=headers, stream=True) as r:
+        if r.status_code == 304:
+            return pd.read_parquet(meta["path"], columns=["MESS_DATUM", "precip_mm"])
+        r.raise_for_status()
+        with _spool_response(r) as buf:
+            df = _read_archive(buf, station_id)
+        etag, last_modified = r.headers.get("ETag"), r.headers.get("Last-Modified")
+
+    if etag or last_modified:
+        path = meta_path.with_suffix(".parquet")
+        meta = {"version": CACHE_VERSION, "etag": etag, "last_modified": last_modified, "path": str(path)}
+        try:
+            _write_atomic(path, lambda f: df.to_parquet(f, compression="zstd", index=False))
+            _write_atomic(meta_path, lambda f: f.write(json.dumps(meta).encode()))
+        except OSError:
+            pass  # Cache ist optional; die Daten sind auch ohne ihn vollständig
+    return df
+
+def lade_daten(datum: date, station_id: str):
+    # Das "recent"-Archiv reicht nur ca. 500 Tage zurück; außerhalb davon nichts laden
+    if datum > date.today() or datum < date.today() - timedelta(days=540):
+        return pd.DataFrame(columns=["datetime", "precip_mm"])
+    df = _parse_station(station_id)
+    # Erst über die ganzzahligen Grenzen auf den Tag filtern, dann nur diese Zeilen umwandeln
+    lo = int(datum.strftime("%Y%m%d00"))
+    df = df[df["MESS_DATUM"].between(lo, lo + 23)]
+    df = df.assign(datetime=_mess_datum_to_datetime(df["MESS_DATUM"]))
+    return df[["datetime", "precip_mm"]]
+
+def lade_alle(datum: date):
+    # Stationen parallel laden, Reihenfolge wie in `stationen`
+    with ThreadPoolExecutor(max_workers=4) as ex:
+        futures = {name: ex.submit(lade_daten, datum, info["id"]) for name, info in stationen.items()}
+        return {name: f.result() for name, f in futures.items()}
 
 def generate_plot(df, datum, station_name):
-    fig, ax = plt.subplots(figsize=(8, 4))
-    bars = ax.bar(df['datetime'].dt.hour, df['precip_mm'], color=["red" if val >= 5 else "skyblue" for val in df['precip_mm']])
+    fig, ax = plt.subplots(figsize=(8, 4), dpi=80)
+    hours = df['datetime'].dt.hour.to_numpy()
+    values = df['precip_mm'].to_numpy()
+    colors = np.where(np.nan_to_num(values) >= 5, "red", "skyblue")
+    bars = ax.bar(hours, values, color=colors)
     ax.set_title(f"Niederschlag am {datum.strftime('%d.%m.%Y')} - {station_name}")
     ax.set_xlabel("Stunde")
     ax.set_ylabel("Niederschlag [mm]")
-    ax.set_xticks(df['datetime'].dt.hour)
+    ax.set_xticks(hours)
     ax.grid(True)
     return fig
 
+@cache_plot
+def plot_png(df, datum, station_name, dpi=80) -> bytes:
+    # Als PNG-Bytes cachen statt als Figure: keine gemeinsam genutzten matplotlib-Objekte zwischen Sitzungen
+    fig = generate_plot(df, datum, station_name)
+    png = io.BytesIO()
+    fig.savefig(png, format="PNG", dpi=dpi, bbox_inches="tight")
+    plt.close(fig)
+    return png.getvalue()
+
 def generate_pdf(data_dict, datum):
     tmpfile = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
     pdf = FPDF()
-    pdf.set_font("Arial", size=11)
+    pdf.set_font("Helvetica", size=11)
 
     for station_name, info in data_dict.items():
         df = info["df"]
-        fig = info["fig"]
         station_id = stationen[station_name]["id"]
         coords = stationen[station_name]["coords"]
-        dwd_url = f"https://opendata.dwd.de/climate_environment/CDC/observations_germany/climate/hourly/precipitation/recent/stundenwerte_RR_{station_id}_akt.zip"
+        dwd_url = DWD_URL.format(station_id=station_id)
 
         pdf.add_page()
-        pdf.cell(200, 10, txt=f"Station: {station_name} ({coords})", ln=1)
-        pdf.cell(200, 8, txt=f"Datum: {datum.strftime('%d.%m.%Y')}", ln=1)
-        pdf.cell(200, 8, txt="Pfad zu den Rohdaten beim DWD:", ln=1)
+        pdf.cell(200, 10, text=f"Station: {station_name} ({coords})", new_x="LMARGIN", new_y="NEXT")
+        pdf.cell(200, 8, text=f"Datum: {datum.strftime('%d.%m.%Y')}", new_x="LMARGIN", new_y="NEXT")
+        pdf.cell(200, 8, text="Pfad zu den Rohdaten beim DWD:", new_x="LMARGIN", new_y="NEXT")
         pdf.set_text_color(0, 0, 255)
-        pdf.multi_cell(0, 8, txt=dwd_url)
+        pdf.multi_cell(0, 8, text=dwd_url, new_x="LMARGIN", new_y="NEXT")
         pdf.set_text_color(0, 0, 0)
 
         total = df['precip_mm'].sum()
-        pdf.cell(200, 8, txt=f"Tagesniederschlagssumme: {total:.1f} mm", ln=1)
+        pdf.cell(200, 8, text=f"Tagesniederschlagssumme: {total:.1f} mm", new_x="LMARGIN", new_y="NEXT")
         pdf.ln(4)
 
-        for index, row in df.iterrows():
-            time = row['datetime'].strftime('%H:%M')
-            value = row['precip_mm']
-            if pd.notna(value):
-                line = f"{time} Uhr: {value:.1f} mm"
-                if value >= 5:
-                    pdf.set_text_color(200, 0, 0)
-                else:
-                    pdf.set_text_color(0, 0, 0)
-                pdf.cell(200, 7, txt=line, ln=1)
+        times = df['datetime'].dt.strftime('%H:%M').to_numpy()
+        values = df['precip_mm'].to_numpy()
+        lines = [(f"{t} Uhr: {v:.1f} mm", v >= 5) for t, v in zip(times, values) if not np.isnan(v)]
+        # Aufeinanderfolgende Zeilen gleicher Farbe als ein Block, Reihenfolge bleibt erhalten
+        for rot, block in itertools.groupby(lines, key=lambda line: line[1]):
+            if rot:
+                pdf.set_text_color(200, 0, 0)
+            else:
+                pdf.set_text_color(0, 0, 0)
+            pdf.multi_cell(200, 7, text="\n".join(text for text, _ in block), new_x="LMARGIN", new_y="NEXT")
 
         pdf.set_text_color(0, 0, 0)
-        plotfile = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-        fig.savefig(plotfile.name)
-        pdf.image(plotfile.name, x=10, y=None, w=190)
+        # PNG kommt fertig aus plot_png; BytesIO umhüllt die Bytes nur, ohne sie zu kopieren
+        pdf.image(io.BytesIO(info["png"]), x=10, y=None, w=190)
 
     pdf.output(tmpfile.name)
     return tmpfile.name
@@ -94,11 +229,10 @@ if GUI:
         with st.spinner("Lade DWD-Daten..."):
             try:
                 data_dict = {}
-                for station_name, info in stationen.items():
-                    df = lade_daten(datum, info["id"])
+                for station_name, df in lade_alle(datum).items():
                     if not df.empty:
-                        fig = generate_plot(df, datum, station_name)
-                        data_dict[station_name] = {"df": df, "fig": fig}
+                        png = plot_png(df, datum, station_name)
+                        data_dict[station_name] = {"df": df, "png": png}
 
                 if not data_dict:
                     st.info("Keine Daten für dieses Datum verfügbar.")
@@ -107,7 +241,8 @@ if GUI:
                         st.subheader(station_name)
                         st.write(f"Koordinaten: {stationen[station_name]['coords']}")
                         st.dataframe(data["df"].set_index("datetime"))
-                        st.pyplot(data["fig"])
+                        # Für den Bildschirm in höherer Auflösung als für das PDF
+                        st.image(plot_png(data["df"], datum, station_name, dpi=200), use_container_width=True)
 
                     csv_combined = pd.concat([
                         df.assign(Station=name) for name, df in [(k, v['df']) for k,v in data_dict.items()]
@@ -124,15 +259,19 @@ else:
     datum = input("Datum eingeben (YYYY-MM-DD): ")
     try:
         parsed_date = datetime.strptime(datum, "%Y-%m-%d").date()
-        for station_name, info in stationen.items():
-            df = lade_daten(parsed_date, info["id"])
+        data_dict = {}
+        for station_name, df in lade_alle(parsed_date).items():
             if df.empty:
                 print(f"Keine Daten für {station_name}")
             else:
                 print(f"--- {station_name} ({stationen[station_name]['coords']}) ---")
                 print(df)
-        print("PDF wird erstellt...")
-        pdf_path = generate_pdf({k: {"df": lade_daten(parsed_date, v["id"]), "fig": generate_plot(lade_daten(parsed_date, v["id"]), parsed_date, k)} for k,v in stationen.items()}, parsed_date)
-        print(f"PDF gespeichert unter: {pdf_path}")
+                png = plot_png(df, parsed_date, station_name)
+                data_dict[station_name] = {"df": df, "png": png}
+
+        if data_dict:
+            print("PDF wird erstellt...")
+            pdf_path = generate_pdf(data_dict, parsed_date)
+            print(f"PDF gespeichert unter: {pdf_path}")
     except Exception as e:
         print(f"Fehler: {e}")